@@ -4,11 +4,14 @@ from __future__ import annotations
 import asyncio
 from contextlib import AsyncExitStack, asynccontextmanager
 from dataclasses import dataclass, replace
+from functools import lru_cache
 import logging
-from typing import Any, AsyncIterator
+import struct
+import sys
+from typing import Any, AsyncIterator, Callable
 from uuid import UUID
 
-from bleak import BleakClient
+from bleak import BleakClient, BleakScanner
 from bleak.backends.device import BLEDevice
 from bleak.backends.scanner import AdvertisementData
 from bleak.exc import BleakError
@@ -27,17 +30,74 @@ COMMAND_AFTERCOOKINGTIMERAUTO = "NachlAut"
 COMMAND_AFTERCOOKINGTIMEROFF = "NachlAus"
 COMMAND_ACTIVATECARBONFILTER = "coal-ava"
 
+_FIXED_COMMANDS = (
+    COMMAND_STOP_FAN,
+    COMMAND_LIGHT_ON_OFF,
+    COMMAND_RESETGREASEFILTER,
+    COMMAND_RESETCHARCOALFILTER,
+    COMMAND_AFTERCOOKINGTIMERMANUAL,
+    COMMAND_AFTERCOOKINGTIMERAUTO,
+    COMMAND_AFTERCOOKINGTIMEROFF,
+    COMMAND_ACTIVATECARBONFILTER,
+)
+
+_FAN_SPEED_COMMANDS = tuple(
+    COMMAND_FORMAT_FAN_SPEED_FORMAT.format(speed) for speed in range(10)
+)
+_AFTER_COOKING_COMMANDS = tuple(
+    COMMAND_FORMAT_AFTERCOOKINGSTRENGTHMANUAL.format(speed) for speed in range(10)
+)
+_PERIODIC_VENTING_COMMANDS = tuple(
+    COMMAND_FORMAT_PERIODIC_VENTING.format(minutes) for minutes in range(60)
+)
+_DIM_COMMANDS = tuple(COMMAND_FORMAT_DIM.format(level) for level in range(101))
+
+_PRECOMPUTED_COMMANDS = (
+    _FIXED_COMMANDS
+    + _FAN_SPEED_COMMANDS
+    + _AFTER_COOKING_COMMANDS
+    + _PERIODIC_VENTING_COMMANDS
+    + _DIM_COMMANDS
+)
+
+# Repeat safe commands, state is resynced from advertisements if lost.
+_NO_RESPONSE_COMMANDS = frozenset(_FAN_SPEED_COMMANDS + _DIM_COMMANDS)
+
 _LOGGER = logging.getLogger(__name__)
 
+# Minimum time to keep a fresh connection open with adaptive delays, some
+# BLE stacks (Android) misbehave if a connection is torn down while still
+# being set up.
+_MIN_CONNECTION_TIME = 2.0
+# Initial delay before disconnect when adapting to usage.
+_DEFAULT_DISCONNECT_DELAY = 5.0
+# Weight of the latest sample in the command interval average.
+_ACTIVITY_SMOOTHING = 0.3
+
 UUID_SERVICE = UUID("{77a2bd49-1e5a-4961-bba1-21f34fa4bc7b}")
 UUID_RX = UUID("{23123e0a-1ad6-43a6-96ac-06f57995330d}")
 UUID_TX = UUID("{68ecc82c-928d-4af0-aa60-0d578ffb35f7}")
 UUID_CONFIG = UUID("{3e06fdc2-f432-404f-b321-dfa909f5c12c}")
 
+_UUID_SERVICE_STR = str(UUID_SERVICE)
+
 DEVICE_NAME = "COOKERHOOD_FJAR"
 ANNOUNCE_PREFIX = b"HOODFJAR"
 ANNOUNCE_MANUFACTURER = int.from_bytes(ANNOUNCE_PREFIX[0:2], "little")
 
+# BluetoothGatt.CONNECTION_PRIORITY_HIGH on Android
+_ANDROID_CONNECTION_PRIORITY_HIGH = 1
+
+_ANNOUNCE_SUFFIX = ANNOUNCE_PREFIX[2:]
+
+# Keycode, fan speed, five flag letters, dim level and periodic venting
+_TX_PARSER = struct.Struct("4x6c3s2s")
+
+if sys.version_info >= (3, 10):
+    _DATACLASS_SLOTS = {"slots": True}
+else:
+    _DATACLASS_SLOTS = {}
+
 class FjaraskupanError(Exception):
     pass
 
@@ -57,7 +117,7 @@ class FjaraskupanTimeout(FjaraskupanError, TimeoutError):
     pass
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, **_DATACLASS_SLOTS)
 class State:
     """Data received from characteristics."""
 
@@ -73,107 +133,298 @@ class State:
     periodic_venting_on: bool = False
     rssi: int = 0
 
-    def replace_from_tx_char(self, databytes: bytes, **changes: Any):
+    def replace_from_tx_char(
+        self, databytes: bytes, rssi: int | None = None, **changes: Any
+    ):
         """Update state based on tx characteristics."""
-        data = databytes.decode("ASCII")
-        return replace(
-            self,
-            fan_speed=int(data[4]),
-            light_on=data[5] == "L",
-            after_cooking_on=data[6] == "N",
-            carbon_filter_available=data[7] == "C",
-            grease_filter_full=data[8] == "F",
-            carbon_filter_full=data[9] == "K",
-            dim_level=_range_check_dim(int(data[10:13]), self.dim_level),
-            periodic_venting=_range_check_period(
-                int(data[13:15]), self.periodic_venting
+        (
+            fan_speed,
+            light_on,
+            after_cooking_on,
+            carbon_filter_available,
+            grease_filter_full,
+            carbon_filter_full,
+            dim_level,
+            periodic_venting,
+        ) = _TX_PARSER.unpack_from(databytes)
+        state = State(
+            light_on=light_on == b"L",
+            after_cooking_fan_speed=self.after_cooking_fan_speed,
+            after_cooking_on=after_cooking_on == b"N",
+            carbon_filter_available=carbon_filter_available == b"C",
+            fan_speed=int(fan_speed),
+            grease_filter_full=grease_filter_full == b"F",
+            carbon_filter_full=carbon_filter_full == b"K",
+            dim_level=_range_check_digits(dim_level, 100, self.dim_level),
+            periodic_venting=_range_check_digits(
+                periodic_venting, 59, self.periodic_venting
             ),
-            **changes
+            periodic_venting_on=self.periodic_venting_on,
+            rssi=self.rssi if rssi is None else rssi,
         )
+        if changes:
+            return replace(state, **changes)
+        return state
 
-    def replace_from_manufacture_data(self, data: bytes, **changes: Any):
+    def replace_from_manufacture_data(
+        self, data: bytes, rssi: int | None = None, **changes: Any
+    ):
         """Update state based on broadcasted data."""
-        light_on = _bittest(data[10], 0)
-        dim_level = _range_check_dim(data[13], self.dim_level)
+        return self.replace_from_announce_data(data[2:], rssi, **changes)
+
+    def replace_from_announce_data(
+        self, data: bytes, rssi: int | None = None, **changes: Any
+    ):
+        """Update state based on broadcasted data without manufacturer id."""
+        flags = data[8]
+        filters = data[9]
+        light_on = (flags & 0x01) != 0
+        dim_level = _range_check_dim(data[11], self.dim_level)
         if light_on and not self.light_on and dim_level < self.dim_level:
             light_on = False
 
-        return replace(
-            self,
-            fan_speed=int(data[8]),
-            after_cooking_fan_speed=int(data[9]),
+        state = State(
             light_on=light_on,
-            after_cooking_on=_bittest(data[10], 1),
-            periodic_venting_on=_bittest(data[10], 2),
-            grease_filter_full=_bittest(data[11], 0),
-            carbon_filter_full=_bittest(data[11], 1),
-            carbon_filter_available=_bittest(data[11], 2),
+            after_cooking_fan_speed=int(data[7]),
+            after_cooking_on=(flags & 0x02) != 0,
+            carbon_filter_available=(filters & 0x04) != 0,
+            fan_speed=int(data[6]),
+            grease_filter_full=(filters & 0x01) != 0,
+            carbon_filter_full=(filters & 0x02) != 0,
             dim_level=dim_level,
-            periodic_venting=_range_check_period(data[14], self.periodic_venting),
-            **changes
+            periodic_venting=_range_check_period(data[12], self.periodic_venting),
+            periodic_venting_on=(flags & 0x04) != 0,
+            rssi=self.rssi if rssi is None else rssi,
         )
+        if changes:
+            return replace(state, **changes)
+        return state
 
 
 def _range_check_dim(value: int, fallback: int):
-    if value >= 0 and value <= 100:
-        return value
-    else:
-        return fallback
+    return value if value <= 100 else fallback
 
 
 def _range_check_period(value: int, fallback: int):
-    if value >= 0 and value < 60:
-        return value
-    else:
-        return fallback
+    return value if value < 60 else fallback
+
+
+def _range_check_digits(digits: bytes, maximum: int, fallback: int):
+    # int() would also accept a sign or whitespace
+    if digits.isdigit():
+        value = int(digits)
+        if value <= maximum:
+            return value
+    return fallback
+
 
+@lru_cache(maxsize=256)
+def _encode_command(cmd: str) -> bytes:
+    return cmd.encode("ASCII")
 
-def _bittest(data: int, bit: int):
-    return (data & (1 << bit)) != 0
+
+def _format_command(commands: tuple[str, ...], fmt: str, value: int) -> str:
+    if 0 <= value < len(commands):
+        return commands[value]
+    return fmt.format(value)
+
+
+def _fail_writes(queue: asyncio.Queue, message: str):
+    while not queue.empty():
+        _, future = queue.get_nowait()
+        if not future.done():
+            future.set_exception(FjaraskupanConnectionError(message))
+
+
+def _supports_write_without_response(client: BleakClient) -> bool:
+    try:
+        characteristic = client.services.get_characteristic(UUID_RX)
+    except BleakError:
+        return False
+    if characteristic is None:
+        return False
+    return "write-without-response" in characteristic.properties
+
+
+def _request_high_connection_priority(client: BleakClient):
+    """Ask for a short connection interval where the backend allows it.
+
+    Bleak has no public api for this, only the Android backend exposes the
+    underlying gatt object. Other backends are left at their defaults.
+    """
+    backend = getattr(client, "_backend", None)
+    gatt = getattr(backend, "_BleakClientP4Android__gatt", None)
+    if gatt is None:
+        return
+    try:
+        gatt.requestConnectionPriority(_ANDROID_CONNECTION_PRIORITY_HIGH)
+    except Exception:  # pylint: disable=broad-except
+        _LOGGER.debug("Failed to request connection priority", exc_info=True)
 
 
 def device_filter(device: BLEDevice, advertisement_data: AdvertisementData) -> bool:
-    uuids = advertisement_data.service_uuids
-    if str(UUID_SERVICE) in uuids:
+    if _UUID_SERVICE_STR in advertisement_data.service_uuids:
         return True
 
     if device.name == DEVICE_NAME:
         return True
 
-    manufacturer_data = advertisement_data.manufacturer_data.get(ANNOUNCE_MANUFACTURER, b'')
-    if manufacturer_data.startswith(ANNOUNCE_PREFIX[2:]):
-        return True
+    manufacturer_data = advertisement_data.manufacturer_data.get(ANNOUNCE_MANUFACTURER)
+    return manufacturer_data is not None and manufacturer_data.startswith(
+        _ANNOUNCE_SUFFIX
+    )
+
 
-    return False
+class _PerLoop:
+    """Create an asyncio primitive lazily, once per running event loop.
+
+    Before Python 3.10 primitives bind to the event loop current at
+    creation, which breaks objects created outside of, or outliving, a loop.
+    """
+
+    def __init__(self, factory: Callable[[], Any]) -> None:
+        self._factory = factory
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._value: Any = None
+
+    def get(self) -> Any:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._value = self._factory()
+        return self._value
 
 
 class Device:
     """Communication handler."""
 
 
-    def __init__(self, address: str, keycode=b"1234", disconnect_delay: float = 5.0) -> None:
-        """Initialize handler."""
+    def __init__(
+        self,
+        address: str,
+        keycode=b"1234",
+        disconnect_delay: float | None = None,
+        min_disconnect_delay: float = 1.0,
+        max_disconnect_delay: float = 10.0,
+    ) -> None:
+        """Initialize handler.
+
+        With a disconnect_delay given, the connection is kept open for that
+        long after use, zero disconnects directly. Without it, the delay is
+        adapted to how often the device is used, bound by min_disconnect_delay
+        and max_disconnect_delay, and a new connection is always held for a
+        short minimum time.
+        """
         self.address = address
         self._keycode = keycode
+        self._payloads = {
+            cmd: keycode + _encode_command(cmd) for cmd in _PRECOMPUTED_COMMANDS
+        }
+        self._no_response_payloads = frozenset(
+            keycode + _encode_command(cmd) for cmd in _NO_RESPONSE_COMMANDS
+        )
         self.state = State()
-        self._lock = asyncio.Lock()
+        self._last_announce: tuple[bytes, int, State] | None = None
+        self._loop_lock = _PerLoop(asyncio.Lock)
         self._client: BleakClient | None = None
         self._client_count = 0
         self._client_stack = AsyncExitStack()
         self._disconnect_delay = disconnect_delay
+        self._min_disconnect_delay = min_disconnect_delay
+        self._max_disconnect_delay = max_disconnect_delay
         self._disconnect_task: asyncio.Task | None = None
+        self._disconnect_deadline: float | None = None
+        self._disconnect_event: asyncio.Event | None = None
+        self._disconnect_timer: asyncio.TimerHandle | None = None
+        self._write_queue: asyncio.Queue[
+            tuple[tuple[bytes, ...], asyncio.Future]
+        ] | None = None
+        self._writer_task: asyncio.Task | None = None
+        self._activity_interval = _DEFAULT_DISCONNECT_DELAY / 2
+        self._last_activity: float | None = None
+        self._connected_at: float | None = None
+
+    def _note_activity(self, now: float):
+        """Track average interval between uses of the connection."""
+        if self._last_activity is not None:
+            interval = now - self._last_activity
+            if interval > self._max_disconnect_delay:
+                # Isolated use, connection would not have been kept for it
+                interval = 0.0
+            self._activity_interval += _ACTIVITY_SMOOTHING * (
+                interval - self._activity_interval
+            )
+        self._last_activity = now
 
-    async def _disconnect_callback(self):
-        await asyncio.sleep(self._disconnect_delay)
-        async with self._lock:
-            await self._disconnect()
+    def _get_disconnect_delay(self, now: float) -> float:
+        if self._disconnect_delay is not None:
+            return self._disconnect_delay
+
+        delay = min(
+            max(2 * self._activity_interval, self._min_disconnect_delay),
+            self._max_disconnect_delay,
+        )
+        if self._connected_at is not None:
+            delay = max(delay, self._connected_at + _MIN_CONNECTION_TIME - now)
+        return delay
+
+    @property
+    def _lock(self) -> asyncio.Lock:
+        return self._loop_lock.get()
+
+    async def _disconnect_callback(self, event: asyncio.Event):
+        """Disconnect once the current deadline passes, then stop."""
+        loop = asyncio.get_running_loop()
+        while self._client is not None:
+            await event.wait()
+            event.clear()
+            deadline = self._disconnect_deadline
+            if deadline is None:
+                continue
+            if deadline > loop.time():
+                # Timers may fire within clock resolution of the deadline
+                self._set_disconnect_timer(deadline)
+                continue
+
+            async with self._lock:
+                deadline = self._disconnect_deadline
+                if deadline is None or deadline > loop.time():
+                    continue
+                try:
+                    await self._disconnect()
+                except FjaraskupanError:
+                    pass
+
+    def _set_disconnect_timer(self, deadline: float | None):
+        if self._disconnect_timer:
+            self._disconnect_timer.cancel()
+            self._disconnect_timer = None
+        if deadline is not None and self._disconnect_event is not None:
+            self._disconnect_timer = asyncio.get_running_loop().call_at(
+                deadline, self._disconnect_event.set
+            )
+
+    def _disconnect_later(self, delay: float):
+        loop = asyncio.get_running_loop()
+        self._disconnect_deadline = loop.time() + delay
+        if self._disconnect_task is None or self._disconnect_task.done():
+            # Created here so it binds to the running loop on all versions
+            self._disconnect_event = asyncio.Event()
+            self._disconnect_task = asyncio.create_task(
+                self._disconnect_callback(self._disconnect_event),
+                name="Fjaraskupen Disconnector",
+            )
+        self._set_disconnect_timer(self._disconnect_deadline)
 
-    async def _disconnect_later(self):
-        self._disconnect_task = asyncio.create_task(self._disconnect_callback(), name="Fjaraskupen Disconnector")
-        
     async def _disconnect(self):
         assert self._client
         self._client = None
+        self._connected_at = None
+        self._disconnect_deadline = None
+        self._set_disconnect_timer(None)
+        if self._disconnect_task and not self._disconnect_task.done():
+            self._disconnect_event.set()
+        await self._stop_writer()
 
         _LOGGER.debug("Disconnecting")
         try:
@@ -201,14 +452,101 @@ class Device:
         except BleakError as exc:
             _LOGGER.debug("Error on connect", exc_info=True)
             raise FjaraskupanConnectionError("Error on connect") from exc
+        self._connected_at = asyncio.get_running_loop().time()
+        _request_high_connection_priority(self._client)
+        self._start_writer(self._client)
         _LOGGER.debug("Connected")
     
+    def _start_writer(self, client: BleakClient):
+        if _supports_write_without_response(client):
+            no_response_payloads = self._no_response_payloads
+        else:
+            no_response_payloads = frozenset()
+        self._write_queue = asyncio.Queue()
+        self._writer_task = asyncio.create_task(
+            self._writer(client, self._write_queue, no_response_payloads),
+            name="Fjaraskupan Writer",
+        )
+
+    async def _stop_writer(self):
+        if self._writer_task:
+            writer_task = self._writer_task
+            self._writer_task = None
+            writer_task.cancel()
+            # Let an interrupted write unwind before the client is closed
+            await asyncio.wait([writer_task])
+
+        if self._write_queue:
+            _fail_writes(self._write_queue, "Disconnected before write")
+            self._write_queue = None
+
+    async def _writer(
+        self,
+        client: BleakClient,
+        queue: asyncio.Queue[tuple[tuple[bytes, ...], asyncio.Future]],
+        no_response_payloads: frozenset[bytes],
+    ):
+        """Write queued batches of payloads to device in order."""
+        try:
+            while True:
+                payloads, future = await queue.get()
+                if future.done():
+                    continue
+                try:
+                    for data in payloads:
+                        await self._write(
+                            client, data, data not in no_response_payloads
+                        )
+                except asyncio.CancelledError:
+                    if not future.done():
+                        future.set_exception(
+                            FjaraskupanConnectionError("Disconnected during write")
+                        )
+                    raise
+                except Exception as exc:  # pylint: disable=broad-except
+                    if not future.done():
+                        future.set_exception(exc)
+                else:
+                    if not future.done():
+                        future.set_result(None)
+        finally:
+            _fail_writes(queue, "Writer stopped")
+
+    async def _write(self, client: BleakClient, data: bytes, response: bool):
+        try:
+            await client.write_gatt_char(UUID_RX, data, response)
+        except asyncio.TimeoutError as exc:
+            _LOGGER.debug("Timeout on write", exc_info=True)
+            raise FjaraskupanTimeout from exc
+        except BleakError as exc:
+            _LOGGER.debug("Failed to write", exc_info=True)
+            raise FjaraskupanWriteError("Failed to write") from exc
+
+    async def _write_payloads(self, *payloads: bytes):
+        """Write payloads back to back, stopping at the first failure."""
+        assert self._write_queue, "Device must be connected"
+        if self._writer_task is None or self._writer_task.done():
+            raise FjaraskupanConnectionError("Writer stopped")
+        future = asyncio.get_running_loop().create_future()
+        self._write_queue.put_nowait((payloads, future))
+        await future
+
+    async def _send_commands(self, *cmds: str):
+        """Send given commands back to back."""
+        for cmd in cmds:
+            assert len(cmd) == 8
+        assert self._client, "Device must be connected"
+        await self._write_payloads(*[self._get_payload(cmd) for cmd in cmds])
+
+    def _get_payload(self, cmd: str) -> bytes:
+        return self._payloads.get(cmd) or (self._keycode + _encode_command(cmd))
+
     @asynccontextmanager
     async def connect(self, address_or_ble_device: BLEDevice | str | None = None) -> AsyncIterator[Device]:
         async with self._lock:
-            if self._disconnect_task:
-                self._disconnect_task.cancel()
-                self._disconnect_task = None
+            self._note_activity(asyncio.get_running_loop().time())
+            self._disconnect_deadline = None
+            self._set_disconnect_timer(None)
 
             if self._client is None:
                 await self._connect(address_or_ble_device)
@@ -222,43 +560,65 @@ class Device:
             async with self._lock:
                 self._client_count -= 1
                 if self._client_count == 0:
-                    if self._disconnect_delay:
-                        await self._disconnect_later()
+                    delay = self._get_disconnect_delay(
+                        asyncio.get_running_loop().time()
+                    )
+                    if delay > 0:
+                        self._disconnect_later(delay)
                     else:
                         await self._disconnect()
 
 
     def characteristic_callback(self, data: bytearray):
         """Handle callback on characteristic change."""
-        _LOGGER.debug("Characteristic callback: %s", data)
+        debug = _LOGGER.isEnabledFor(logging.DEBUG)
+        if debug:
+            _LOGGER.debug("Characteristic callback: %s", data)
 
-        if data[0:4] != self._keycode:
+        if not data.startswith(self._keycode):
             _LOGGER.warning("Wrong keycode in data %s", data)
             return
 
         self.state = self.state.replace_from_tx_char(data)
 
-        _LOGGER.debug("Characteristic callback result: %s", self.state)
+        if debug:
+            _LOGGER.debug("Characteristic callback result: %s", self.state)
 
     def detection_callback(self, device: BLEDevice, advertisement_data: AdvertisementData):
         """Handle scanner data."""
         data = advertisement_data.manufacturer_data.get(ANNOUNCE_MANUFACTURER)
         if data is None:
             return
-        # Recover full manufacturer data. It's breaking standard by
-        # not providing a manufacturer prefix here.
-        data = ANNOUNCE_PREFIX[0:2] + data
-        self.detection_callback_raw(data, advertisement_data.rssi)
+        # The manufacturer id has been stripped off by the scanner. It's
+        # breaking standard by using part of the prefix as manufacturer id.
+        if not data.startswith(_ANNOUNCE_SUFFIX):
+            _LOGGER.debug("Missing key in manufacturer data %s", data)
+            return
+        self._detection_callback_announce(data, advertisement_data.rssi)
 
     def detection_callback_raw(self, data: bytes, rssi: int):
 
-        if data[0:8] != ANNOUNCE_PREFIX:
+        if not data.startswith(ANNOUNCE_PREFIX):
             _LOGGER.debug("Missing key in manufacturer data %s", data)
             return
 
-        self.state = self.state.replace_from_manufacture_data(data, rssi=rssi)
+        self._detection_callback_announce(data[2:], rssi)
+
+    def _detection_callback_announce(self, data: bytes, rssi: int):
+        last = self._last_announce
+        if (
+            last is not None
+            and last[2] is self.state
+            and last[1] == rssi
+            and last[0] == data
+        ):
+            return
 
-        _LOGGER.debug("Detection callback result: %s", self.state)
+        self.state = self.state.replace_from_announce_data(data, rssi=rssi)
+        self._last_announce = (bytes(data), rssi, self.state)
+
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug("Detection callback result: %s", self.state)
 
     async def update(self):
         async with self._lock:
@@ -283,20 +643,20 @@ class Device:
         async with self._lock:
             await self._send_command(cmd)
 
+    async def send_commands(self, *cmds: str):
+        """Send given commands back to back, stopping at the first failure."""
+        async with self._lock:
+            await self._send_commands(*cmds)
+            for cmd in cmds:
+                self._apply_command(cmd)
+
     async def _send_command(self, cmd: str):
         """Send given command."""
-        assert len(cmd) == 8
-        assert self._client, "Device must be connected"
-        data = self._keycode + cmd.encode("ASCII")
-        try:
-            await self._client.write_gatt_char(UUID_RX, data, True)
-        except asyncio.TimeoutError as exc:
-            _LOGGER.debug("Timeout on write", exc_info=True)
-            raise FjaraskupanTimeout from exc
-        except BleakError as exc:
-            _LOGGER.debug("Failed to write", exc_info=True)
-            raise FjaraskupanWriteError("Failed to write") from exc
+        await self._send_commands(cmd)
+        self._apply_command(cmd)
 
+    def _apply_command(self, cmd: str):
+        """Update state to match a sent command."""
         if cmd == COMMAND_STOP_FAN:
             self.state = replace(self.state, fan_speed=0)
         elif cmd == COMMAND_LIGHT_ON_OFF:
@@ -311,25 +671,121 @@ class Device:
     async def send_fan_speed(self, speed: int):
         """Set numbered fan speed."""
         async with self._lock:
-            await self._send_command(COMMAND_FORMAT_FAN_SPEED_FORMAT.format(speed))
+            await self._send_command(
+                _format_command(
+                    _FAN_SPEED_COMMANDS, COMMAND_FORMAT_FAN_SPEED_FORMAT, speed
+                )
+            )
             self.state = replace(self.state, fan_speed=speed)
 
     async def send_after_cooking(self, speed: int):
         """Set numbered fan speed."""
         async with self._lock:
-            await self._send_command(COMMAND_FORMAT_AFTERCOOKINGSTRENGTHMANUAL.format(speed))
+            await self._send_command(
+                _format_command(
+                    _AFTER_COOKING_COMMANDS,
+                    COMMAND_FORMAT_AFTERCOOKINGSTRENGTHMANUAL,
+                    speed,
+                )
+            )
             self.state = replace(self.state, after_cooking_fan_speed=speed)
 
     async def send_periodic_venting(self, minutes: int):
         """Set periodic venting."""
         async with self._lock:
-            await self._send_command(COMMAND_FORMAT_PERIODIC_VENTING.format(minutes))
+            await self._send_command(
+                _format_command(
+                    _PERIODIC_VENTING_COMMANDS, COMMAND_FORMAT_PERIODIC_VENTING, minutes
+                )
+            )
             self.state = replace(self.state, periodic_venting=minutes)
 
     async def send_dim(self, level: int):
         """Ask to dim to a certain level."""
         async with self._lock:
+            dim = _format_command(_DIM_COMMANDS, COMMAND_FORMAT_DIM, level)
             if self.state.light_on ^ (level > 0):
-                await self._send_command(COMMAND_LIGHT_ON_OFF)
-            await self._send_command(COMMAND_FORMAT_DIM.format(level))
+                await self._send_commands(COMMAND_LIGHT_ON_OFF, dim)
+            else:
+                await self._send_commands(dim)
             self.state = replace(self.state, dim_level=level, light_on=level > 0)
+
+
+class DeviceRegistry:
+    """Shared scanner dispatching advertisements to registered devices."""
+
+    def __init__(self) -> None:
+        """Initialize registry."""
+        self._devices: dict[str, Device] = {}
+        self._callbacks: list[Callable[[BLEDevice, AdvertisementData], None]] = []
+        self._scanner: BleakScanner | None = None
+        self._users = 0
+        self._lock = _PerLoop(asyncio.Lock)
+
+    def add(self, device: Device):
+        """Route advertisements for the device's address to it."""
+        self._devices[device.address.upper()] = device
+
+    def remove(self, device: Device):
+        """Stop routing advertisements to device."""
+        key = device.address.upper()
+        if self._devices.get(key) is device:
+            del self._devices[key]
+
+    def add_callback(
+        self, callback: Callable[[BLEDevice, AdvertisementData], None]
+    ) -> Callable[[], None]:
+        """Call callback for every advertisement, returns a remove function."""
+        self._callbacks.append(callback)
+
+        def _remove():
+            self._callbacks.remove(callback)
+
+        return _remove
+
+    def detection_callback(self, device: BLEDevice, advertisement_data: AdvertisementData):
+        """Handle scanner data."""
+        # Bleak reports addresses upper case, so no need to normalize here
+        registered = self._devices.get(device.address)
+        if registered is not None:
+            registered.detection_callback(device, advertisement_data)
+
+        for callback in self._callbacks:
+            callback(device, advertisement_data)
+
+    async def __aenter__(self) -> DeviceRegistry:
+        async with self._lock.get():
+            if self._users == 0:
+                scanner = BleakScanner(detection_callback=self.detection_callback)
+                try:
+                    await scanner.start()
+                except BleakError as exc:
+                    _LOGGER.debug("Error on scanner start", exc_info=True)
+                    raise FjaraskupanBleakError("Error on scanner start") from exc
+                self._scanner = scanner
+            self._users += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        async with self._lock.get():
+            self._users -= 1
+            if self._users or self._scanner is None:
+                return
+            scanner = self._scanner
+            self._scanner = None
+            try:
+                await scanner.stop()
+            except BleakError as exc:
+                _LOGGER.debug("Error on scanner stop", exc_info=True)
+                raise FjaraskupanBleakError("Error on scanner stop") from exc
+
+
+_REGISTRY: DeviceRegistry | None = None
+
+
+def device_registry() -> DeviceRegistry:
+    """Get the process wide device registry."""
+    global _REGISTRY
+    if _REGISTRY is None:
+        _REGISTRY = DeviceRegistry()
+    return _REGISTRY
@@ -1,10 +1,9 @@
 import asyncio
 import argparse
-from bleak import BleakScanner, BleakClient
 from bleak.backends.device import BLEDevice
 from bleak.backends.scanner import AdvertisementData
 
-from . import COMMAND_LIGHT_ON_OFF, Device, device_filter
+from . import COMMAND_LIGHT_ON_OFF, Device, device_filter, device_registry
 
 parser = argparse.ArgumentParser(description="Control kitchen fans")
 
@@ -29,12 +28,17 @@ parse_command.add_argument("command", type=str)
 
 async def async_scan(args):
 
-    async def detection(device: BLEDevice, advertisement_data: AdvertisementData):
+    def detection(device: BLEDevice, advertisement_data: AdvertisementData):
         if device_filter(device, advertisement_data):
             print(f"Detection: {device} - {advertisement_data}")
 
-    async with BleakScanner(detection_callback=detection):
-        await asyncio.sleep(args.timeout)
+    registry = device_registry()
+    remove = registry.add_callback(detection)
+    try:
+        async with registry:
+            await asyncio.sleep(args.timeout)
+    finally:
+        remove()
 
 async def async_light(args):
     async with Device(args.device).connect() as device:
@@ -1,5 +1,81 @@
+import asyncio
 from dataclasses import replace
-from fjaraskupan import State
+from types import SimpleNamespace
+
+import pytest
+
+from bleak.exc import BleakError
+
+import fjaraskupan
+from fjaraskupan import (
+    ANNOUNCE_MANUFACTURER,
+    COMMAND_AFTERCOOKINGTIMERAUTO,
+    COMMAND_LIGHT_ON_OFF,
+    COMMAND_RESETCHARCOALFILTER,
+    COMMAND_RESETGREASEFILTER,
+    COMMAND_STOP_FAN,
+    Device,
+    DeviceRegistry,
+    FjaraskupanConnectionError,
+    FjaraskupanWriteError,
+    State,
+)
+
+
+class FakeClient:
+    """Stand in for BleakClient recording written payloads."""
+
+    properties = ["write", "write-without-response"]
+
+    def __init__(self, address):
+        self.writes = []
+        self.responses = []
+        self.errors = {}
+        self.closed = False
+        self.write_delay = 0
+        self.writing = False
+        self.closed_while_writing = False
+        self.services = SimpleNamespace(
+            get_characteristic=lambda uuid: SimpleNamespace(
+                properties=self.properties
+            )
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.closed = True
+        self.closed_while_writing = self.writing
+
+    async def read_gatt_char(self, uuid):
+        return bytearray(b"12340_____00000")
+
+    async def write_gatt_char(self, uuid, data, response=True):
+        self.writing = True
+        try:
+            await asyncio.sleep(self.write_delay)
+        finally:
+            self.writing = False
+        error = self.errors.get(bytes(data))
+        if error:
+            raise error
+        self.writes.append(bytes(data))
+        self.responses.append((bytes(data), response))
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    created = []
+
+    def _create(address):
+        client = FakeClient(address)
+        created.append(client)
+        return client
+
+    monkeypatch.setattr(fjaraskupan, "BleakClient", _create)
+    monkeypatch.setattr(fjaraskupan, "_MIN_CONNECTION_TIME", 0.0)
+    return created
 
 def test_parse_announce():
     state = State().replace_from_manufacture_data(b"HOODFJAR\x00\x00\x00\x00\x00\x00\x00")
@@ -81,3 +157,313 @@ def test_parse_rx():
 
     state = State().replace_from_tx_char(b"12348_____10061")
     assert state == replace(state, periodic_venting=0)
+
+    state = State(dim_level=40, periodic_venting=7).replace_from_tx_char(
+        b"12340_____-01-5"
+    )
+    assert state.dim_level == 40
+    assert state.periodic_venting == 7
+
+
+def test_parse_announce_without_manufacturer():
+    data = b"HOODFJAR\x01\x02\x07\x07\x00\x30\x04"
+    assert State().replace_from_announce_data(
+        data[2:]
+    ) == State().replace_from_manufacture_data(data)
+
+
+def test_shared_connection_serializes_commands(clients):
+    async def run():
+        device = Device("AA:BB:CC:DD:EE:FF", disconnect_delay=0)
+
+        async def other():
+            async with device.connect():
+                await device.send_dim(50)
+
+        async with device.connect():
+            task = asyncio.create_task(other())
+            await asyncio.sleep(0)
+            await device.send_dim(30)
+            await task
+        return device
+
+    device = asyncio.run(run())
+    (client,) = clients
+    assert client.writes.count(b"1234" + COMMAND_LIGHT_ON_OFF.encode()) == 1
+    assert len(client.writes) == 3
+    assert device.state.light_on is True
+    assert client.closed
+
+
+def test_duplicate_announce():
+    device = Device("AA:BB:CC:DD:EE:FF")
+    data = b"HOODFJAR\x01\x02\x00\x00\x00\x30\x04"
+
+    device.detection_callback_raw(data, -50)
+    state = device.state
+    assert state.fan_speed == 1
+
+    device.detection_callback_raw(data, -50)
+    assert device.state is state
+
+    device.detection_callback_raw(data, -60)
+    assert device.state == replace(state, rssi=-60)
+
+    device.state = replace(device.state, fan_speed=3)
+    device.detection_callback_raw(data, -60)
+    assert device.state.fan_speed == 1
+
+
+def test_registry_dispatch():
+    registry = DeviceRegistry()
+    device = Device("aa:bb:cc:dd:ee:ff")
+    other = Device("11:22:33:44:55:66")
+    registry.add(device)
+    registry.add(other)
+    seen = []
+    remove = registry.add_callback(lambda ble_device, _: seen.append(ble_device))
+
+    ble_device = SimpleNamespace(address="AA:BB:CC:DD:EE:FF", name=None)
+    advertisement_data = SimpleNamespace(
+        manufacturer_data={
+            ANNOUNCE_MANUFACTURER: b"ODFJAR\x01\x02\x00\x00\x00\x30\x04"
+        },
+        rssi=-40,
+    )
+    registry.detection_callback(ble_device, advertisement_data)
+    assert device.state.fan_speed == 1
+    assert device.state.rssi == -40
+    assert other.state == State()
+    assert seen == [ble_device]
+
+    remove()
+    registry.remove(device)
+    registry.detection_callback(
+        ble_device,
+        SimpleNamespace(manufacturer_data=advertisement_data.manufacturer_data, rssi=-10),
+    )
+    assert device.state.rssi == -40
+    assert seen == [ble_device]
+
+
+def test_write_errors_reach_caller(clients):
+    async def run():
+        device = Device("AA:BB:CC:DD:EE:FF", disconnect_delay=0)
+        async with device.connect():
+            (client,) = clients
+            client.errors[b"1234" + COMMAND_STOP_FAN.encode()] = OSError("gone")
+            with pytest.raises(OSError):
+                await asyncio.wait_for(device.send_command(COMMAND_STOP_FAN), 1)
+            await asyncio.wait_for(device.send_fan_speed(3), 1)
+            return client
+
+    client = asyncio.run(run())
+    assert client.writes == [b"1234-Luft-3-"]
+
+
+def test_dim_stops_after_failed_toggle(clients):
+    async def run():
+        device = Device("AA:BB:CC:DD:EE:FF", disconnect_delay=0)
+        async with device.connect():
+            (client,) = clients
+            client.errors[b"1234" + COMMAND_LIGHT_ON_OFF.encode()] = BleakError()
+            with pytest.raises(FjaraskupanWriteError):
+                await device.send_dim(30)
+            with pytest.raises(AssertionError):
+                await device.send_dim(1000)
+            return device, client
+
+    device, client = asyncio.run(run())
+    assert client.writes == []
+    assert device.state == State()
+
+
+def test_fixed_disconnect_delay(clients, monkeypatch):
+    monkeypatch.setattr(fjaraskupan, "_MIN_CONNECTION_TIME", 10.0)
+
+    async def run():
+        device = Device("AA:BB:CC:DD:EE:FF", disconnect_delay=30)
+        async with device.connect():
+            assert device._get_disconnect_delay(0.0) == 30
+
+        device = Device("AA:BB:CC:DD:EE:FF", disconnect_delay=0)
+        async with device.connect():
+            pass
+        assert clients[1].closed
+        assert device._client is None
+
+    asyncio.run(run())
+
+
+def test_adaptive_disconnect_delay(monkeypatch):
+    monkeypatch.setattr(fjaraskupan, "_MIN_CONNECTION_TIME", 2.0)
+    device = Device(
+        "AA:BB:CC:DD:EE:FF", min_disconnect_delay=1.0, max_disconnect_delay=10.0
+    )
+    assert device._get_disconnect_delay(0.0) == pytest.approx(5.0)
+
+    # Burst of uses two seconds apart keeps the average near two seconds
+    for now in range(0, 20, 2):
+        device._note_activity(float(now))
+    assert device._get_disconnect_delay(20.0) == pytest.approx(4.0, abs=0.2)
+
+    # Isolated uses shrink the delay down to the minimum
+    for now in range(100, 1000, 100):
+        device._note_activity(float(now))
+    assert device._get_disconnect_delay(1000.0) == pytest.approx(1.0)
+
+    # Slow bursts grow it up to the maximum
+    for now in range(1000, 1100, 9):
+        device._note_activity(float(now))
+    assert device._get_disconnect_delay(1100.0) == pytest.approx(10.0)
+
+    # Fresh connections are held for a minimum time
+    for now in range(2000, 3000, 100):
+        device._note_activity(float(now))
+    device._connected_at = 3000.0
+    assert device._get_disconnect_delay(3000.5) == pytest.approx(1.5)
+
+
+def test_disconnect_deadline_moved_earlier(clients):
+    async def run():
+        device = Device("AA:BB:CC:DD:EE:FF", disconnect_delay=30)
+        async with device.connect():
+            pass
+        task = device._disconnect_task
+        await asyncio.sleep(0)
+
+        device._disconnect_later(0.01)
+        await asyncio.wait_for(task, 1)
+        assert device._client is None
+        assert clients[0].closed
+
+    asyncio.run(run())
+
+
+def test_registry_scanner_lifetime(monkeypatch):
+    scanners = []
+
+    class FakeScanner:
+        fail = False
+
+        def __init__(self, detection_callback):
+            self.running = False
+            scanners.append(self)
+
+        async def start(self):
+            await asyncio.sleep(0)
+            if FakeScanner.fail:
+                FakeScanner.fail = False
+                raise RuntimeError("adapter busy")
+            self.running = True
+
+        async def stop(self):
+            self.running = False
+
+    monkeypatch.setattr(fjaraskupan, "BleakScanner", FakeScanner)
+
+    registry = DeviceRegistry()
+
+    async def run():
+        FakeScanner.fail = True
+        with pytest.raises(RuntimeError):
+            async with registry:
+                pass
+
+        async def user():
+            async with registry:
+                assert scanners[-1].running
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(user(), user())
+        assert not scanners[-1].running
+
+    asyncio.run(run())
+    # Registry outlives its first event loop
+    asyncio.run(run())
+    assert len(scanners) == 4
+
+
+def test_disconnect_without_task_churn(clients):
+    device = Device("AA:BB:CC:DD:EE:FF", disconnect_delay=0.05)
+
+    async def run():
+        seen = set()
+        for speed in range(5):
+            async with device.connect():
+                await device.send_fan_speed(speed)
+            await asyncio.sleep(0.01)
+            seen |= asyncio.all_tasks()
+        disconnector = device._disconnect_task
+        await asyncio.wait_for(disconnector, 1)
+        return seen, disconnector
+
+    seen, disconnector = asyncio.run(run())
+    # Main task, the connection's writer and a single disconnector
+    assert len(seen) == 3
+    assert disconnector in seen
+    assert len(clients) == 1
+    assert clients[0].closed
+    assert device._client is None
+
+
+def test_send_commands_batch(clients):
+    async def run():
+        device = Device("AA:BB:CC:DD:EE:FF", disconnect_delay=0)
+        device.state = replace(device.state, fan_speed=3, after_cooking_fan_speed=2)
+        async with device.connect():
+            await device.send_commands(COMMAND_STOP_FAN, COMMAND_AFTERCOOKINGTIMERAUTO)
+        return device
+
+    device = asyncio.run(run())
+    assert clients[0].writes == [
+        b"1234" + COMMAND_STOP_FAN.encode(),
+        b"1234" + COMMAND_AFTERCOOKINGTIMERAUTO.encode(),
+    ]
+    assert device.state == replace(State(), after_cooking_on=True)
+
+
+def test_disconnect_waits_for_writer(clients):
+    async def run():
+        device = Device("AA:BB:CC:DD:EE:FF", disconnect_delay=0)
+        await device._connect(None)
+        (client,) = clients
+        client.write_delay = 1
+        task = asyncio.create_task(device.send_command(COMMAND_STOP_FAN))
+        await asyncio.sleep(0.01)
+        assert client.writing
+
+        await device._disconnect()
+        with pytest.raises(FjaraskupanConnectionError):
+            await task
+        return client
+
+    client = asyncio.run(run())
+    assert client.closed
+    assert not client.closed_while_writing
+
+
+async def _send_response_mix(device):
+    async with device.connect():
+        await device.send_fan_speed(4)
+        await device.send_dim(60)
+        await device.send_command(COMMAND_RESETGREASEFILTER)
+        await device.send_command(COMMAND_RESETCHARCOALFILTER)
+
+
+def test_write_without_response(clients):
+    asyncio.run(_send_response_mix(Device("AA:BB:CC:DD:EE:FF", disconnect_delay=0)))
+    assert clients[0].responses == [
+        (b"1234-Luft-4-", False),
+        (b"1234" + COMMAND_LIGHT_ON_OFF.encode(), True),
+        (b"1234-Dim060-", False),
+        (b"1234" + COMMAND_RESETGREASEFILTER.encode(), True),
+        (b"1234" + COMMAND_RESETCHARCOALFILTER.encode(), True),
+    ]
+
+
+def test_write_without_response_unsupported(clients, monkeypatch):
+    monkeypatch.setattr(FakeClient, "properties", ["write"])
+    asyncio.run(_send_response_mix(Device("AA:BB:CC:DD:EE:FF", disconnect_delay=0)))
+    assert clients[0].responses
+    assert all(response for _, response in clients[0].responses)